@@ -1,8 +1,13 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Request, render_template, request, jsonify
 from flask_cors import CORS
 from PIL import Image
+from contextlib import contextmanager
 import io
 import re
+import hashlib
+import mmap
+import tempfile
+import threading
 import numpy as np
 from urllib.parse import urlparse, parse_qs
 import base64
@@ -10,6 +15,12 @@ import logging
 import sys
 import os
 from migration_pb2 import parse_migration_payload
+from single_flight import SingleFlight, CoalesceTimeoutError
+
+try:
+    import resource  # 仅 Unix 可用，用于读取进程峰值内存
+except ImportError:
+    resource = None
 
 app = Flask(__name__)
 CORS(app)
@@ -33,6 +44,136 @@ logger.info("=" * 60)
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
+# 上传请求体超过该阈值（字节）时落盘到临时文件，解码时通过 mmap 映射，不占用进程堆内存
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv('UPLOAD_SPOOL_THRESHOLD', 512 * 1024))
+# 临时文件目录，默认使用系统临时目录；上传内容包含 2FA 密钥，不要指向持久化存储
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR') or tempfile.gettempdir()
+
+
+class SpoolingRequest(Request):
+    """按请求体大小决定上传文件缓存在内存还是临时文件中"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is None or total_content_length > UPLOAD_SPOOL_THRESHOLD:
+            spool_dir = UPLOAD_SPOOL_DIR if os.path.isdir(UPLOAD_SPOOL_DIR) else None
+            return tempfile.TemporaryFile('wb+', dir=spool_dir)
+        return io.BytesIO()
+
+
+app.request_class = SpoolingRequest
+
+
+class MemoryTracker:
+    """统计单个请求在各阶段持有的缓冲区字节数，并记录峰值（不含 OpenCV 内部临时分配）"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self.mapped = 0  # mmap 映射的字节数，由页缓存承载，不计入峰值
+
+    def acquire(self, nbytes):
+        self.current += nbytes
+        if self.current > self.peak:
+            self.peak = self.current
+
+    def release(self, nbytes):
+        self.current -= nbytes
+
+
+# 全局内存统计，用于根据内存估算 worker 数量
+memory_stats_lock = threading.Lock()
+memory_stats = {
+    'requests': 0,
+    'spooled_requests': 0,
+    'decoded_requests': 0,    # 完成了解码的请求，峰值统计只包含这部分
+    'coalesced_requests': 0,  # 复用其他请求解码结果的请求
+    'timed_out_requests': 0,  # 排队或解码超时的请求
+    'failed_requests': 0,     # 因其他异常未完成解码的请求
+    'peak_bytes_max': 0,
+    'peak_bytes_total': 0,
+}
+
+
+def record_memory_stats(tracker, spooled, status):
+    """汇总单个请求的峰值内存
+
+    status 为 decoded、coalesced、timed_out 或 failed。只有 decoded 的请求计入峰值统计，
+    其余请求没有完整解码，只持有上传数据，计入会拉低峰值平均值
+    """
+    with memory_stats_lock:
+        memory_stats['requests'] += 1
+        if spooled:
+            memory_stats['spooled_requests'] += 1
+        memory_stats[f'{status}_requests'] += 1
+        if status != 'decoded':
+            return
+        memory_stats['peak_bytes_total'] += tracker.peak
+        if tracker.peak > memory_stats['peak_bytes_max']:
+            memory_stats['peak_bytes_max'] = tracker.peak
+
+
+# 解码超时时间（秒），从开始解码时计算，相同图片的所有并发请求共用
+DECODE_COALESCE_TIMEOUT = float(os.getenv('DECODE_COALESCE_TIMEOUT', 30))
+# 解码线程数，0 表示使用 ThreadPoolExecutor 的默认值 min(32, CPU 数 + 4)
+DECODE_WORKERS = int(os.getenv('DECODE_WORKERS', 0))
+# 解码线程全部繁忙时，请求排队等待的最长时间（秒），超过后返回 504；所有上传（包括不重复的）都受此限制
+DECODE_QUEUE_TIMEOUT = float(os.getenv('DECODE_QUEUE_TIMEOUT', 30))
+
+
+# 按图片内容摘要合并并发的相同解码请求
+decode_flight = SingleFlight(DECODE_COALESCE_TIMEOUT, DECODE_WORKERS or None, DECODE_QUEUE_TIMEOUT)
+
+
+@contextmanager
+def open_upload_buffer(file):
+    """以只读缓冲区的形式打开上传文件，避免 file.read() 产生额外的副本
+
+    返回 (buffer, spooled)：落盘的文件通过 mmap 映射，内存中的文件直接复用 BytesIO 的底层缓冲区
+    """
+    stream = file.stream
+    if isinstance(stream, io.BytesIO):
+        view = stream.getbuffer()
+        try:
+            yield view, False
+        finally:
+            try:
+                view.release()
+                # 解码完成后立即释放上传数据
+                stream.close()
+            except BufferError:
+                # 仍有 numpy 视图引用缓冲区，替换掉 FileStorage 的流，
+                # 避免请求结束关闭 BytesIO 时报错，原缓冲区交由垃圾回收释放
+                logger.warning("上传缓冲区仍被引用，延迟释放")
+                file.stream = io.BytesIO()
+        return
+
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fileno = None
+
+    if fileno is None:
+        # 无法映射的流，退回到一次性读取
+        stream.seek(0)
+        yield stream.read(), False
+        return
+
+    stream.flush()
+    if os.fstat(fileno).st_size == 0:
+        # 空文件无法 mmap
+        yield b'', True
+        return
+
+    mm = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    try:
+        yield mm, True
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # 仍有 numpy 视图引用映射，交由垃圾回收关闭
+            logger.warning("mmap 仍被引用，延迟关闭")
+
 def extract_secret_from_otpauth(url):
     """从 otpauth URL 中提取密钥"""
     try:
@@ -84,8 +225,14 @@ def extract_secrets_from_migration(data_base64):
         logger.error(f"解析迁移格式错误: {e}", exc_info=True)
         return None
 
-def parse_qr_code(image_data):
-    """解析二维码图片并提取密钥"""
+def parse_qr_code(image_data, mem_tracker=None):
+    """解析二维码图片并提取密钥
+
+    image_data 可以是 base64 字符串或任意支持缓冲区协议的对象（bytes、memoryview、mmap）。
+    传入 mem_tracker 时记录各阶段中间图像占用的内存。
+    """
+    if mem_tracker is None:
+        mem_tracker = MemoryTracker()
     try:
         import cv2
         
@@ -96,19 +243,27 @@ def parse_qr_code(image_data):
             if image_data.startswith('data:image'):
                 # 移除 data:image/png;base64, 前缀
                 image_data = image_data.split(',')[1]
-            image_bytes = base64.b64decode(image_data)
-            nparr = np.frombuffer(image_bytes, np.uint8)
-        else:
-            nparr = np.frombuffer(image_data, np.uint8)
+            image_data = base64.b64decode(image_data)
+            mem_tracker.acquire(len(image_data))
+        # frombuffer 只创建视图，不复制数据（mmap 时直接读取映射页）
+        nparr = np.frombuffer(image_data, np.uint8)
+        del image_data
         
         # 使用 OpenCV 解码图片
         img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # 解码完成后立即释放对原始数据的引用
+        del nparr
         
         if img is None:
             return None, "无法读取图片，请确保图片格式正确"
+        mem_tracker.acquire(img.nbytes)
         
         # 转换为灰度图（二维码检测需要）
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        mem_tracker.acquire(gray.nbytes)
+        # 彩色图不再需要，立即释放
+        mem_tracker.release(img.nbytes)
+        del img
         
         # 使用 OpenCV 的 QRCodeDetector 解析二维码
         detector = cv2.QRCodeDetector()
@@ -259,6 +414,10 @@ def parse_qr_code(image_data):
             except Exception as e:
                 pass
         
+        # 检测完成，释放灰度图
+        mem_tracker.release(gray.nbytes)
+        del gray
+        
         if not retval_bool or not decoded_info:
             return None, "未检测到二维码，请确保图片清晰且包含有效的二维码"
         
@@ -358,14 +517,37 @@ def convert_qr():
             logger.warning(f"[{client_ip}] 不允许的文件类型: {file.filename}")
             return jsonify({'success': False, 'error': f'不支持的文件类型，仅支持: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
         
-        # 读取文件数据
-        file.seek(0)
-        image_data = file.read()
-        file_size = len(image_data)
-        logger.info(f"[{client_ip}] 开始解析二维码，文件名: {file.filename}, 大小: {file_size} 字节")
+        # 以只读缓冲区读取文件数据（大文件通过 mmap 映射，不复制）
+        mem_tracker = MemoryTracker()
+        spooled = False
+        shared = False
+        decode_status = 'failed'
+        try:
+            with open_upload_buffer(file) as (image_data, spooled):
+                file_size = len(image_data)
+                if spooled:
+                    mem_tracker.mapped = file_size
+                else:
+                    mem_tracker.acquire(file_size)
+                logger.info(f"[{client_ip}] 开始解析二维码，文件名: {file.filename}, 大小: {file_size} 字节, 落盘: {spooled}")
+                
+                # 解析二维码，相同图片的并发请求共享同一次解码
+                digest = hashlib.sha256(image_data).hexdigest()
+                try:
+                    (result, error), shared = decode_flight.do(digest, parse_qr_code, image_data, mem_tracker)
+                    decode_status = 'coalesced' if shared else 'decoded'
+                except CoalesceTimeoutError:
+                    decode_status = 'timed_out'
+                    raise
+                finally:
+                    del image_data
+        finally:
+            # 无论成功、失败还是超时都记录内存统计
+            record_memory_stats(mem_tracker, spooled, decode_status)
+            logger.info(f"[{client_ip}] 请求峰值内存: {mem_tracker.peak} 字节 (mmap 映射: {mem_tracker.mapped} 字节, 解码状态: {decode_status})")
         
-        # 解析二维码
-        result, error = parse_qr_code(image_data)
+        if shared:
+            logger.info(f"[{client_ip}] 复用进行中的相同图片解码结果: {digest[:16]}")
         
         if error:
             logger.warning(f"[{client_ip}] 二维码解析失败: {error}")
@@ -407,10 +589,27 @@ def convert_qr():
             logger.warning(f"[{client_ip}] 无法提取密钥")
             return jsonify({'success': False, 'error': '无法提取密钥'}), 400
     
+    except CoalesceTimeoutError as e:
+        logger.warning(f"[{client_ip}] {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 504
     except Exception as e:
         logger.error(f"[{client_ip}] 服务器错误: {str(e)}", exc_info=True)
         return jsonify({'success': False, 'error': f'服务器错误: {str(e)}'}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """返回内存与请求合并统计，用于根据内存估算 worker 数量"""
+    with memory_stats_lock:
+        stats = dict(memory_stats)
+    peak_bytes_total = stats.pop('peak_bytes_total')
+    decoded_requests = stats['decoded_requests']
+    stats['peak_bytes_avg'] = peak_bytes_total // decoded_requests if decoded_requests else 0
+    stats['spool_threshold_bytes'] = UPLOAD_SPOOL_THRESHOLD
+    if resource is not None:
+        # Linux 下 ru_maxrss 单位为 KB
+        stats['process_max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return jsonify({'memory': stats, 'coalescing': decode_flight.snapshot()})
+
 def format_secret(secret):
     """格式化密钥，每 4 个字符一组"""
     # 移除空格
@@ -0,0 +1,169 @@
+"""合并相同 key 的并发调用（single-flight）
+
+同一时间相同 key 只执行一次，其余调用等待并共享结果。调用在线程池中执行，有两个独立的时限：
+
+- 排队时限：线程池已满时，调用在队列中等待超过 queue_timeout 即放弃，尚未开始的调用不会再执行
+- 执行时限：从调用真正开始执行时计算，主调用方与等待者共用同一个截止时间；超时后该调用被标记为失败，
+  在底层执行真正结束前，新到达的相同请求直接返回超时，不会重复发起无法中断的执行
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class CoalesceTimeoutError(Exception):
+    """等待解码结果超时"""
+
+
+class CoalescedDecodeError(Exception):
+    """合并执行的调用失败，原始异常见 __cause__"""
+
+
+class _InFlightCall:
+    """一次正在进行的调用，状态字段由 SingleFlight 的锁保护"""
+
+    def __init__(self):
+        self.queued = time.monotonic()
+        self.started = None  # 开始执行的时间，排队中为 None
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.timed_out = False
+        self.future = None
+        self.waiters = 0  # 等待共享结果的请求数
+
+
+class SingleFlight:
+    """合并相同 key 的并发调用：同一时间只执行一次，其余调用等待并共享结果或异常"""
+
+    def __init__(self, timeout, max_workers=None, queue_timeout=None):
+        self.timeout = timeout
+        self.queue_timeout = timeout if queue_timeout is None else queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='single-flight')
+        self._lock = threading.Lock()
+        # 调用开始执行或结束时通知所有等待者
+        self._changed = threading.Condition(self._lock)
+        self._calls = {}
+        self._stats = {
+            'executions': 0,      # 实际执行的次数
+            'coalesced': 0,       # 复用了进行中调用结果的次数（即节省的执行次数）
+            'timeouts': 0,        # 因执行超时返回失败的次数
+            'queue_timeouts': 0,  # 因排队超时返回失败的次数
+        }
+
+    def do(self, key, fn, *args, **kwargs):
+        """执行 fn 或等待已在执行的相同调用，返回 (result, shared)
+
+        超时抛出 CoalesceTimeoutError，fn 抛出的异常以 CoalescedDecodeError 包装后抛出
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+                self._stats['executions'] += 1
+            elif call.timed_out:
+                # 相同调用已超时但仍在执行，直接失败，等它真正结束后才允许重新执行
+                self._stats['timeouts'] += 1
+                raise CoalesceTimeoutError(f"相同图片的解码已超时（{self.timeout} 秒），请稍后重试")
+            else:
+                call.waiters += 1
+
+        if leader:
+            try:
+                call.future = self._executor.submit(self._run, key, call, fn, args, kwargs)
+            except Exception as e:
+                # 提交失败（如线程池已关闭），移除记录并唤醒已加入的等待者
+                with self._changed:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+                    call.exception = e
+                    call.done = True
+                    self._changed.notify_all()
+
+        with self._changed:
+            try:
+                self._wait(key, call)
+            finally:
+                if not leader:
+                    call.waiters -= 1
+            if not leader:
+                self._stats['coalesced'] += 1
+
+        if call.exception is not None:
+            raise CoalescedDecodeError(f"解码失败: {call.exception}") from call.exception
+        return call.result, not leader
+
+    def _wait(self, key, call):
+        """等待调用结束，超过排队或执行时限时抛出 CoalesceTimeoutError，需持有锁调用"""
+        while not call.done:
+            if call.timed_out:
+                # 其他等待者已判定超时
+                raise self._timeout_error(call)
+            if call.started is None:
+                remaining = call.queued + self.queue_timeout - time.monotonic()
+                if remaining <= 0:
+                    # 尚未开始执行，直接放弃：_run 开始时会检查 timed_out 并跳过执行
+                    call.timed_out = True
+                    if call.future is not None:
+                        call.future.cancel()
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+                    raise self._timeout_error(call)
+            else:
+                remaining = call.started + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    # 保留记录直到执行真正结束，避免重复发起无法中断的执行
+                    call.timed_out = True
+                    raise self._timeout_error(call)
+            self._changed.wait(remaining)
+
+    def _timeout_error(self, call):
+        """记录超时并返回对应的异常，需持有锁调用"""
+        if call.started is None:
+            self._stats['queue_timeouts'] += 1
+            return CoalesceTimeoutError(f"解码排队超时（{self.queue_timeout} 秒），服务器繁忙")
+        self._stats['timeouts'] += 1
+        return CoalesceTimeoutError(f"解码超时（{self.timeout} 秒）")
+
+    def _run(self, key, call, fn, args, kwargs):
+        """在线程池中执行调用，结束后移除记录并唤醒等待者"""
+        with self._changed:
+            if call.timed_out:
+                # 排队超时，等待者已放弃
+                return
+            call.started = time.monotonic()
+            self._changed.notify_all()
+
+        result = None
+        exception = None
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"合并执行的调用失败: {e}", exc_info=True)
+            # 去掉执行线程的栈帧，避免等待者长期持有其中的缓冲区
+            exception = e.with_traceback(None)
+        except BaseException:
+            # KeyboardInterrupt 等不传递给等待者，只告知执行被中断
+            exception = CoalescedDecodeError("执行被中断")
+            raise
+        finally:
+            with self._changed:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call.result = result
+                call.exception = exception
+                call.done = True
+                self._changed.notify_all()
+
+    def snapshot(self):
+        """返回统计数据副本"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+            stats['waiting'] = sum(call.waiters for call in self._calls.values())
+        return stats
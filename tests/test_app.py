@@ -0,0 +1,128 @@
+import io
+import mmap
+import tempfile
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+from werkzeug.datastructures import FileStorage
+
+import app as app_module
+from single_flight import CoalesceTimeoutError
+
+SECRET = 'JBSWY3DPEHPK3PXP'
+
+
+def make_qr_png():
+    """生成包含 otpauth URL 的二维码 PNG"""
+    qr = cv2.QRCodeEncoder.create().encode(f'otpauth://totp/test?secret={SECRET}')
+    qr = cv2.resize(qr, None, fx=8, fy=8, interpolation=cv2.INTER_NEAREST)
+    qr = cv2.copyMakeBorder(qr, 32, 32, 32, 32, cv2.BORDER_CONSTANT, value=255)
+    ok, png = cv2.imencode('.png', qr)
+    assert ok
+    return png.tobytes()
+
+
+class OpenUploadBufferTest(unittest.TestCase):
+
+    def test_bytesio_uses_underlying_buffer(self):
+        file = FileStorage(io.BytesIO(b'abc'), filename='qr.png')
+        with app_module.open_upload_buffer(file) as (buffer, spooled):
+            self.assertIsInstance(buffer, memoryview)
+            self.assertEqual(bytes(buffer), b'abc')
+            self.assertFalse(spooled)
+        # 用完后立即关闭流，释放上传数据
+        self.assertTrue(file.stream.closed)
+
+    def test_bytesio_still_exported_swaps_stream(self):
+        stream = io.BytesIO(b'abc')
+        file = FileStorage(stream, filename='qr.png')
+        with app_module.open_upload_buffer(file) as (buffer, spooled):
+            view = np.frombuffer(buffer, np.uint8)
+        # 仍被引用时不报错，FileStorage 换成新的流，请求结束时关闭不会失败
+        self.assertIsNot(file.stream, stream)
+        file.close()
+        del view
+        stream.close()
+
+    def test_temp_file_is_memory_mapped(self):
+        with tempfile.TemporaryFile('wb+') as stream:
+            stream.write(b'abc')
+            stream.seek(0)
+            with app_module.open_upload_buffer(FileStorage(stream, filename='qr.png')) as (buffer, spooled):
+                self.assertIsInstance(buffer, mmap.mmap)
+                self.assertEqual(buffer[:], b'abc')
+                self.assertTrue(spooled)
+            self.assertTrue(buffer.closed)
+
+    def test_empty_temp_file(self):
+        with tempfile.TemporaryFile('wb+') as stream:
+            with app_module.open_upload_buffer(FileStorage(stream, filename='qr.png')) as (buffer, spooled):
+                self.assertEqual(buffer, b'')
+                self.assertTrue(spooled)
+
+    def test_stream_without_fileno_is_read(self):
+        stream = io.BufferedReader(io.BytesIO(b'abc'))
+        with app_module.open_upload_buffer(FileStorage(stream, filename='qr.png')) as (buffer, spooled):
+            self.assertEqual(buffer, b'abc')
+            self.assertFalse(spooled)
+
+
+class ConvertTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.png = make_qr_png()
+
+    def setUp(self):
+        for key in app_module.memory_stats:
+            app_module.memory_stats[key] = 0
+        self.client = app_module.app.test_client()
+
+    def upload(self):
+        return self.client.post('/api/convert', data={'image': (io.BytesIO(self.png), 'qr.png')})
+
+    def memory_metrics(self):
+        return self.client.get('/api/metrics').get_json()['memory']
+
+    def test_small_upload_stays_in_memory(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['secret'], SECRET)
+
+        memory = self.memory_metrics()
+        self.assertEqual(memory['requests'], 1)
+        self.assertEqual(memory['decoded_requests'], 1)
+        self.assertEqual(memory['spooled_requests'], 0)
+        # 峰值至少包含上传数据与灰度图
+        self.assertGreater(memory['peak_bytes_max'], len(self.png))
+        self.assertEqual(memory['peak_bytes_avg'], memory['peak_bytes_max'])
+
+    def test_upload_above_threshold_is_spooled(self):
+        with mock.patch.object(app_module, 'UPLOAD_SPOOL_THRESHOLD', len(self.png) // 2):
+            response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['secret'], SECRET)
+
+        memory = self.memory_metrics()
+        self.assertEqual(memory['spooled_requests'], 1)
+        self.assertEqual(memory['decoded_requests'], 1)
+
+    def test_timed_out_request_not_counted_in_peak(self):
+        self.upload()
+        peak = self.memory_metrics()['peak_bytes_max']
+
+        with mock.patch.object(app_module.decode_flight, 'do', side_effect=CoalesceTimeoutError('timeout')):
+            response = self.upload()
+        self.assertEqual(response.status_code, 504)
+
+        memory = self.memory_metrics()
+        self.assertEqual(memory['requests'], 2)
+        self.assertEqual(memory['decoded_requests'], 1)
+        self.assertEqual(memory['timed_out_requests'], 1)
+        self.assertEqual(memory['peak_bytes_avg'], peak)
+
+
+if __name__ == '__main__':
+    unittest.main()
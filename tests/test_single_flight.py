@@ -0,0 +1,183 @@
+import threading
+import time
+import unittest
+
+from single_flight import SingleFlight, CoalesceTimeoutError, CoalescedDecodeError
+
+# 等待线程状态变化的最长时间，只在失败时才会等满
+WAIT_LIMIT = 10
+
+
+def wait_until(predicate):
+    """轮询直到 predicate 为真，超过 WAIT_LIMIT 则失败"""
+    deadline = time.monotonic() + WAIT_LIMIT
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待条件超时")
+        time.sleep(0.01)
+
+
+class Request(threading.Thread):
+    """在线程中调用 flight.do，保存结果或异常"""
+
+    def __init__(self, flight, key, fn):
+        super().__init__()
+        self.flight = flight
+        self.key = key
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.flight.do(self.key, self.fn)
+        except Exception as e:
+            self.error = e
+
+
+class BlockingDecode:
+    """调用后阻塞直到 release，记录调用次数"""
+
+    def __init__(self, result='SECRET', error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.released.wait(WAIT_LIMIT)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def join_waiters(self, flight, key, decode, count):
+        """启动 count 个等待者，并确认它们都已加入进行中的调用"""
+        waiters = [Request(flight, key, decode) for _ in range(count)]
+        wait_until(lambda: flight.snapshot()['waiting'] == count)
+        return waiters
+
+    def test_shared_result(self):
+        flight = SingleFlight(WAIT_LIMIT)
+        decode = BlockingDecode()
+        leader = Request(flight, 'key', decode)
+        decode.started.wait(WAIT_LIMIT)
+        waiters = self.join_waiters(flight, 'key', decode, 7)
+
+        decode.released.set()
+        for request in [leader] + waiters:
+            request.join()
+
+        self.assertEqual(decode.calls, 1)
+        self.assertEqual(leader.result, ('SECRET', False))
+        for request in waiters:
+            self.assertEqual(request.result, ('SECRET', True))
+        self.assertEqual(flight.snapshot(), {
+            'executions': 1, 'coalesced': 7, 'timeouts': 0, 'queue_timeouts': 0, 'in_flight': 0, 'waiting': 0,
+        })
+
+    def test_shared_error(self):
+        flight = SingleFlight(WAIT_LIMIT)
+        original = ValueError('bad image')
+        decode = BlockingDecode(error=original)
+        leader = Request(flight, 'key', decode)
+        decode.started.wait(WAIT_LIMIT)
+        waiters = self.join_waiters(flight, 'key', decode, 3)
+
+        decode.released.set()
+        requests = [leader] + waiters
+        for request in requests:
+            request.join()
+
+        for request in requests:
+            self.assertIsInstance(request.error, CoalescedDecodeError)
+            self.assertIs(request.error.__cause__, original)
+        # 每个请求得到独立的异常对象
+        self.assertEqual(len({id(request.error) for request in requests}), 4)
+        self.assertEqual(flight.snapshot()['executions'], 1)
+
+    def test_timeout_uses_execution_deadline_and_keeps_entry(self):
+        timeout = 2
+        flight = SingleFlight(timeout)
+        decode = BlockingDecode()
+        leader = Request(flight, 'key', decode)
+        decode.started.wait(WAIT_LIMIT)
+
+        # 晚到的等待者只等待剩余时间（约 timeout / 2），而不是完整的 timeout
+        time.sleep(timeout / 2)
+        joined = time.monotonic()
+        waiter = Request(flight, 'key', decode)
+        waiter.join()
+        leader.join()
+        self.assertIsInstance(waiter.error, CoalesceTimeoutError)
+        self.assertLess(time.monotonic() - joined, timeout * 0.9)
+        # 主请求同样受超时限制
+        self.assertIsInstance(leader.error, CoalesceTimeoutError)
+
+        # 原调用仍在执行，新请求直接失败，不会重复执行
+        with self.assertRaises(CoalesceTimeoutError):
+            flight.do('key', decode)
+        self.assertEqual(decode.calls, 1)
+        self.assertEqual(flight.snapshot()['in_flight'], 1)
+
+        # 原调用结束后允许重新执行
+        decode.released.set()
+        wait_until(lambda: flight.snapshot()['in_flight'] == 0)
+        self.assertEqual(flight.do('key', decode), ('SECRET', False))
+        self.assertEqual(decode.calls, 2)
+
+        self.assertEqual(flight.snapshot(), {
+            'executions': 2, 'coalesced': 0, 'timeouts': 3, 'queue_timeouts': 0, 'in_flight': 0, 'waiting': 0,
+        })
+
+    def test_queue_time_not_counted_as_execution(self):
+        flight = SingleFlight(0.5, max_workers=1, queue_timeout=WAIT_LIMIT)
+        blocker = BlockingDecode()
+        first = Request(flight, 'first', blocker)
+        blocker.started.wait(WAIT_LIMIT)
+
+        # 第二个请求排队时间远超执行时限，但自身执行很快，应当成功
+        second = Request(flight, 'second', lambda: 'SECOND')
+        first.join()
+        blocker.released.set()
+        second.join()
+
+        self.assertIsInstance(first.error, CoalesceTimeoutError)
+        self.assertEqual(second.result, ('SECOND', False))
+
+    def test_queue_timeout_skips_execution(self):
+        flight = SingleFlight(WAIT_LIMIT, max_workers=1, queue_timeout=0.2)
+        blocker = BlockingDecode()
+        first = Request(flight, 'first', blocker)
+        blocker.started.wait(WAIT_LIMIT)
+
+        skipped = []
+        with self.assertRaises(CoalesceTimeoutError):
+            flight.do('second', lambda: skipped.append(1))
+        self.assertEqual(flight.snapshot()['in_flight'], 1)
+
+        blocker.released.set()
+        first.join()
+        # 线程池只有一个线程，按顺序执行：第三个调用完成时被放弃的调用已被跳过
+        self.assertEqual(flight.do('third', lambda: 'THIRD'), ('THIRD', False))
+        self.assertEqual(skipped, [])
+        self.assertEqual(flight.snapshot()['queue_timeouts'], 1)
+
+    def test_submit_failure_releases_entry(self):
+        flight = SingleFlight(WAIT_LIMIT)
+        flight._executor.shutdown()
+
+        with self.assertRaises(CoalescedDecodeError) as ctx:
+            flight.do('key', lambda: 'SECRET')
+        self.assertIsInstance(ctx.exception.__cause__, RuntimeError)
+        self.assertEqual(flight.snapshot()['in_flight'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()